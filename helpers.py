@@ -1,47 +1,59 @@
 # Standard library imports
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from io import BytesIO
+import os
 from pathlib import Path
+import queue
 import imageio.v3 as iio
 import matplotlib.pyplot as plt
 from matplotlib_scalebar.scalebar import ScaleBar
 import numpy as np
-from skimage import exposure, filters, registration, util
+from scipy import fft, ndimage
+from skimage import exposure, util
+import tifffile
+# pyFFTW is optional; if installed, it is used as the scipy.fft backend
+try:
+    import pyfftw
+    pyfftw.interfaces.cache.enable()
+    FFT_BACKEND = pyfftw.interfaces.scipy_fft
+except ImportError:
+    FFT_BACKEND = 'scipy'
 
 
-def align_and_sub_liq(imgs, clip=[0.1, 99.9], hist_eq_clip_lim=0.0001):
+def align_and_sub_liq(
+        imgs, clip=[0.1, 99.9], hist_eq_clip_lim=0.0001, reg_downsample=1):
     # Median filter images before converting to float
     print('Applying median filter...')
-    imgs_med = filters.median(imgs)
-    # Convert image to float before calculations
-    imgs_float = util.img_as_float(imgs_med)
-    # Calculate max offset between first and last image
-    print('Calculating max offset between first and last images...')
-    offset, error, diffphase = registration.phase_cross_correlation(
-            imgs_float[0, :, :], imgs_float[-1, :, :])
-    max_offset_r = int(offset[0])
-    max_offset_c = int(offset[1])
+    imgs_med = np.empty_like(imgs)
+
+    def median_filter_img(i):
+        imgs_med[i] = ndimage.median_filter(imgs[i], size=3, mode='nearest')
+
+    # Filter each image in parallel (median_filter releases the GIL)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(median_filter_img, range(imgs.shape[0])))
+    # Convert image to single precision float before calculations
+    imgs_float = util.img_as_float32(imgs_med)
+    # Calculate offset of each image relative to the first image up front
+    print('Calculating offset of each image relative to first image...')
+    offsets = calc_offsets(imgs_float, downsample=reg_downsample)
+    # Max offset is the offset between first and last image
+    max_offset_r, max_offset_c = offsets[-1]
     # Calc liquid-subtracted images with offset/drift-correction
-    imgs_crctd = np.zeros(
-            (imgs_float.shape[0],
-             imgs_float.shape[1] - abs(max_offset_r),
-             imgs_float.shape[2] - abs(max_offset_c)))
+    n_rows = imgs_float.shape[1] - abs(max_offset_r)
+    n_cols = imgs_float.shape[2] - abs(max_offset_c)
+    imgs_crctd = np.empty(
+            (imgs_float.shape[0], n_rows, n_cols), dtype=np.float32)
+    # Liquid image is the same cropped first image for every subtraction
+    img_liq = imgs_float[0, :n_rows, :n_cols]
+    # Row and column where the crop of each image starts
+    crop_starts = np.abs(offsets)
     # Iterate through each image and perform subtraction adjusting for offset
     print('Aligning each image and subtracting liquid image...')
-    for i in range(imgs_float.shape[0]):
-        offset, error, diffphase = registration.phase_cross_correlation(
-                imgs_float[0, :, :], imgs_float[i, :, :])
-        offset_r = int(offset[0])
-        offset_c = int(offset[1])
-        img_liq = imgs_float[
-                0,
-                : imgs_float.shape[1] - abs(max_offset_r),
-                : imgs_float.shape[2] - abs(max_offset_c)]
-        img_i = imgs_float[
-                i,
-                abs(offset_r) :
-                        imgs.shape[1] - (abs(max_offset_r) - abs(offset_r)),
-                abs(offset_c) :
-                        imgs.shape[2] - (abs(max_offset_c) - abs(offset_c))]
-        imgs_crctd[i, :, :] = img_i - img_liq
+    for i, (r0, c0) in enumerate(crop_starts):
+        np.subtract(
+                imgs_float[i, r0 : r0 + n_rows, c0 : c0 + n_cols], img_liq,
+                out=imgs_crctd[i, :, :])
     if clip is not None:
         print('Clipping highest and lowest intensities...')
         low, high = np.percentile(imgs_crctd, (clip[0], clip[1]))
@@ -55,6 +67,50 @@ def align_and_sub_liq(imgs, clip=[0.1, 99.9], hist_eq_clip_lim=0.0001):
     print(f'{imgs_crctd.shape[0]} images processed.')
     return imgs_crctd
 
+def calc_offsets(imgs, downsample=1):
+    """Calculate offset of each image in a stack relative to the first image
+    using phase cross-correlation
+
+    Parameters
+    ----------
+    imgs : np.ndarray
+        NxHxW Numpy array (N: number of images, H: height, W: width)
+        representing stack of images to be registered
+    downsample : int, optional
+        Factor by which images are downsampled before calculating offsets.
+        Offsets are scaled back up to full resolution, so they will be
+        multiples of downsample. Values above 1 speed up registration by
+        roughly downsample**2 at the cost of precision. Defaults to 1.
+
+    Returns
+    -------
+    np.ndarray
+        Nx2 array of integer (row, col) offsets of each image relative to
+        the first image. Equivalent to the integer part of the shift from
+        skimage.registration.phase_cross_correlation(imgs[0], imgs[i])
+        when downsample is 1.
+    """
+    imgs = imgs[:, ::downsample, ::downsample]
+    shape = np.array(imgs.shape[1:])
+    midpoints = shape // 2
+    eps = np.finfo(np.result_type(imgs.dtype, np.float32)).eps
+    offsets = np.zeros((imgs.shape[0], 2), dtype=int)
+    # FFT of reference image is calculated once instead of for every image.
+    # Images are real, so real FFTs give the same cross-correlation while
+    # only computing half of the spectrum
+    with fft.set_backend(FFT_BACKEND):
+        ref_fft = fft.rfft2(imgs[0, :, :], workers=-1)
+        for i in range(1, imgs.shape[0]):
+            img_product = ref_fft * fft.rfft2(imgs[i, :, :], workers=-1).conj()
+            img_product /= np.maximum(np.abs(img_product), 100 * eps)
+            cross_corr = fft.irfft2(img_product, s=imgs.shape[1:], workers=-1)
+            peak = np.array(np.unravel_index(
+                    np.argmax(np.abs(cross_corr)), cross_corr.shape))
+            # Peaks past the midpoint correspond to negative shifts
+            peak[peak > midpoints] -= shape[peak > midpoints]
+            offsets[i] = peak
+    return offsets * downsample
+
 def get_imgs(
     img_dir_path,
     img_start=None,
@@ -62,7 +118,8 @@ def get_imgs(
     img_step=None,
     n_imgs=None,
     print_nums=False,
-    img_suffix='tif'
+    img_suffix='tif',
+    n_workers=None,
 ):
     """Load a specific range of images from a directory
 
@@ -79,6 +136,10 @@ def get_imgs(
         Defaults to None
     img_suffix : str, optional
         File suffix of images in img_dir_path, by default 'tif'
+    n_workers : None or int, optional
+        Number of threads used to read images from disk in parallel, and
+        number of threads used to decode them. If None, uses the number of
+        CPUs (capped at 16). Defaults to None.
 
     Returns
     -------
@@ -98,9 +159,13 @@ def get_imgs(
     # Ensure img_suffix doesn't begin with a period
     if img_suffix[0] == '.':
         img_suffix = img_suffix[1:]
-    # Make list of paths to images in director located at img_dir_path
-    img_paths = [img_path for img_path in img_dir_path.glob(f'*.{img_suffix}')]
-    img_paths.sort()
+    # Make sorted list of paths to images in directory located at
+    # img_dir_path. os.scandir gets file names and types in a single pass
+    # without the per-file overhead of Path.glob and Path objects
+    with os.scandir(img_dir_path) as entries:
+        img_paths = sorted(
+                entry.path for entry in entries
+                if entry.name.endswith(f'.{img_suffix}') and entry.is_file())
     if img_start is None:
         img_start = 0
     if img_stop is None:
@@ -111,14 +176,61 @@ def get_imgs(
         img_step = 1
     img_nums = np.arange(img_start, img_stop, img_step)
     print(f'Loading {len(img_nums)} images...')
-    imgs = [iio.imread(img_paths[n]) for n in img_nums]
+    # Look up paths of images to load once, up front
+    selected_paths = [img_paths[n] for n in img_nums.tolist()]
+    if n_workers is None:
+        n_workers = min(16, os.cpu_count() or 1)
+    # Read first image to get shape and dtype of the stack, then allocate
+    # the stack once and have each thread write its image into place
+    img_0 = iio.imread(selected_paths[0])
+    imgs = np.empty((len(img_nums), *img_0.shape), dtype=img_0.dtype)
+    imgs[0] = img_0
+    # Reader threads put raw file contents in a bounded queue that decoder
+    # threads take from, so disk reads overlap with decoding
+    raw_queue = queue.Queue(maxsize=2 * n_workers)
+    decode_errors = []
+
+    def read_imgs(img_is):
+        for i in img_is:
+            with open(selected_paths[i], 'rb') as f:
+                raw_queue.put((i, f.read()))
+
+    def decode_imgs():
+        # Keep taking from the queue until a None is received, even after an
+        # error, so that reader threads never block on a full queue
+        for i, raw in iter(raw_queue.get, None):
+            try:
+                if img_suffix.lower() in ('tif', 'tiff'):
+                    # Decode TIFFs directly into their slot of the stack
+                    tifffile.imread(BytesIO(raw), out=imgs[i])
+                else:
+                    imgs[i] = iio.imread(raw, extension=f'.{img_suffix}')
+            except Exception as e:
+                decode_errors.append(e)
+
+    # Read and decode images in parallel (file reads and TIFF decoding
+    # release the GIL)
+    with ThreadPoolExecutor(max_workers=2 * n_workers) as executor:
+        decoders = [executor.submit(decode_imgs) for _ in range(n_workers)]
+        readers = [
+                executor.submit(
+                        read_imgs, range(1 + n, len(img_nums), n_workers))
+                for n in range(n_workers)]
+        wait(readers)
+        # Signal each decoder to stop once all raw images are queued
+        for _ in decoders:
+            raw_queue.put(None)
+    for reader in readers:
+        reader.result()
+    if decode_errors:
+        raise decode_errors[0]
     if print_nums:
         img_map = [f'{i}: {img_n}' for i, img_n in enumerate(img_nums)]
         print('Images loaded:')
         print(img_map)
     else:
         print('Images loaded.')
-    return np.stack(imgs, axis=0)
+    return imgs
 
 def save_as_gif(
     save_path,
@@ -159,18 +271,72 @@ def save_as_gif(
     if save_path.exists():
         raise ValueError(f'File already exists: {save_path}')
     print('Saving animation...')
-    # Add each slice of imgs to a list of images
-    img_list = [imgs[i, :, :] for i in range(imgs.shape[0])]
-    # Iterate through images in list
-    for i, img in enumerate(img_list):
+
+    def to_ubyte(img):
+        # Same conversion util.img_as_ubyte does for floats in [0, 1], done
+        # in place on one float32 buffer and without its range-check passes
+        if img.dtype.kind != 'f':
+            return util.img_as_ubyte(img)
+        img_ubyte = np.multiply(img, 255, dtype=np.float32)
+        np.rint(img_ubyte, out=img_ubyte)
+        np.clip(img_ubyte, 0, 255, out=img_ubyte)
+        return img_ubyte.astype(np.uint8)
+
+    def equalize_to_ubyte(img):
+        return to_ubyte(exposure.equalize_adapthist(img))
+
+    # Write each frame to the GIF as it becomes available instead of
+    # collecting all the converted frames in a list first
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
         if equalize_hist:
-            img = exposure.equalize_adapthist(img)
-        img = util.img_as_ubyte(img)
-        img_list[i] = img
-    # Save list of images as frames in GIF
-    iio.mimsave(save_path, img_list, fps=fps)
+            # Equalize frames in parallel threads; map yields frames in order
+            # so writing overlaps with equalizing later frames. A single
+            # equalize_adapthist call on the stack with kernel_size=(1, ...)
+            # is slower than per-frame calls and doesn't give the same result
+            frames = executor.map(equalize_to_ubyte, imgs)
+        elif imgs.dtype == np.uint8:
+            # Frames can be written as they are
+            frames = imgs
+        else:
+            # Convert the whole stack in one pass
+            frames = to_ubyte(imgs)
+        with iio.imopen(save_path, 'w', plugin='pillow') as writer:
+            for img in frames:
+                writer.write(img, duration=1000 / fps, loop=0)
     print(f'Animation saved: {save_path}')
 
+def _save_png_chunk(
+        save_paths, imgs, timestamp_strs, scalebar_dict, timestamp_dict):
+    """Save a chunk of images of the stack for save_as_pngs. Defined at module
+    level so it can be run in worker processes. A single figure is created
+    for the chunk and its image and timestamp are updated for each image.
+    """
+    if scalebar_dict is None and timestamp_dict is None:
+        for save_path, img in zip(save_paths, imgs):
+            iio.imwrite(save_path, img, compress_level=1)
+        return
+    fig, ax = plt.subplots(dpi=300)
+    img_artist = ax.imshow(imgs[0], vmin=0, vmax=1, cmap='gray')
+    ax.set_axis_off()
+    if scalebar_dict is not None:
+        # Create scale bar
+        scalebar = ScaleBar(**scalebar_dict)
+        ax.add_artist(scalebar)
+    if timestamp_dict is not None:
+        # Create timestamp, text is set for each image below
+        timestamp_text = ax.text(
+                timestamp_dict['x'], timestamp_dict['y'], '',
+                ha="left", va="center", size=9,
+                bbox=dict(boxstyle="square,pad=0.2", fc="white", ec="None"))
+    for save_path, img, timestamp_str in zip(save_paths, imgs, timestamp_strs):
+        img_artist.set_data(img)
+        if timestamp_dict is not None:
+            timestamp_text.set_text(timestamp_str)
+        fig.savefig(
+                save_path, dpi=300, bbox_inches='tight',
+                pil_kwargs=dict(compress_level=1))
+    plt.close(fig)
+
 def save_as_pngs(
         save_dir,
         imgs,
@@ -179,7 +345,8 @@ def save_as_pngs(
                 border_pad=0.5, location='lower right'),
         timestamp_dict=dict(
                 x=25, y=50, fps=0.8459, digits_before_dec=3,
-                digits_after_dec=3)):
+                digits_after_dec=3),
+        n_workers=None):
     save_dir = Path(save_dir)
     if not save_dir.is_dir():
         save_dir.mkdir(parents=True)
@@ -189,33 +356,36 @@ def save_as_pngs(
     n_imgs = imgs.shape[0]
     n_digits = len(str(n_imgs))
     print('Saving images...')
-    for i in range(n_imgs):
-        save_path = Path(save_dir) / f'{exp_name}_{str(i).zfill(n_digits)}.png'
-        if scalebar_dict is not None or timestamp_dict is not None:
-            fig, ax = plt.subplots(dpi=300)
-            ax.imshow(imgs[i, :, :], vmin=0, vmax=1, cmap='gray')
-            ax.set_axis_off()
-            if scalebar_dict is not None:
-                # Create scale bar
-                scalebar = ScaleBar(**scalebar_dict)
-                ax.add_artist(scalebar)
-            if timestamp_dict is not None:
-                # Create timestamp
-                timestamp_val = format(
-                        i / timestamp_dict['fps'],
-                        f".{timestamp_dict['digits_after_dec']}f")
-                total_digits = (
-                        1 + timestamp_dict['digits_after_dec']
-                        + timestamp_dict['digits_before_dec'])
-                timestamp_str = (
-                        f'{str(timestamp_val).zfill(total_digits)} s')
-                ax.text(
-                        timestamp_dict['x'], timestamp_dict['y'], timestamp_str,
-                        ha="left", va="center", size=9,
-                        bbox=dict(boxstyle="square,pad=0.2", fc="white", ec="None"))
-            fig.savefig(save_path, dpi=300, bbox_inches='tight')
-            plt.close(fig)
-        else:
-            iio.imwrite(save_path, imgs[i, :, :])
-    print(f'{i + 1} images saved to: {save_dir}')
-
+    save_paths = [
+            save_dir / f'{exp_name}_{str(i).zfill(n_digits)}.png'
+            for i in range(n_imgs)]
+    if timestamp_dict is not None:
+        # Format timestamp of each image, zero-padded to total_digits
+        total_digits = (
+                1 + timestamp_dict['digits_after_dec']
+                + timestamp_dict['digits_before_dec'])
+        timestamp_strs = [
+                f"{t:0{total_digits}.{timestamp_dict['digits_after_dec']}f} s"
+                for t in np.arange(n_imgs) / timestamp_dict['fps']]
+    else:
+        timestamp_strs = [None] * n_imgs
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    # Split images into one chunk per worker so each worker only creates
+    # one figure
+    chunks = [
+            chunk for chunk in np.array_split(np.arange(n_imgs), n_workers)
+            if chunk.size > 0]
+    # Save images in parallel processes (matplotlib is not thread-safe)
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [
+                executor.submit(
+                        _save_png_chunk,
+                        save_paths[chunk[0] : chunk[-1] + 1],
+                        imgs[chunk[0] : chunk[-1] + 1],
+                        timestamp_strs[chunk[0] : chunk[-1] + 1],
+                        scalebar_dict, timestamp_dict)
+                for chunk in chunks]
+        for future in futures:
+            future.result()
+    print(f'{n_imgs} images saved to: {save_dir}')